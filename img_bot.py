@@ -1,13 +1,22 @@
 import os
 import io
-import time
+import re
+import asyncio
+import hashlib
+import queue
+import sqlite3
+import functools
+import threading
 import requests
-import gspread
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from prefect import flow, task
-from huggingface_hub import InferenceClient
-from PIL import Image
+
+# NOTE: gspread and huggingface_hub are imported lazily inside the
+# functions that need them (see get_google_sheets / get_hf_client).
+# They cost hundreds of ms of startup and tens of MB of RAM, which the
+# "queue empty" fast path never needs. PIL is not imported at all: we
+# only touch the image object the InferenceClient already returns.
 
 # 1. LOAD ENVIRONMENT VARIABLES
 # Load variables from the .env file
@@ -19,8 +28,67 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 HF_TOKEN = os.getenv("HF_TOKEN")
 
+# FAIL FAST: Without a Hugging Face token every run would open Sheets,
+# fetch a prompt, and then burn three retries on a guaranteed 401.
+# Stop at startup instead, before spending a single API call.
+if not HF_TOKEN:
+    raise SystemExit("❌ Missing HF_TOKEN. Set it in your .env file or GitHub Secrets.")
+
+# Shared HTTP session for all Telegram calls.
+# A Session keeps the TCP/TLS connection to api.telegram.org alive, so
+# the second request (e.g. photo + status message) skips the DNS lookup
+# and TLS handshake (~100-300 ms each).
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4))
+
+# SHARED ERROR CLASSIFICATION
+# One precompiled regex scan + one dict lookup replaces the chains of
+# sequential substring checks that were duplicated in generate_img and
+# main_flow. Each call site keeps its own user-facing messages; only the
+# "which kind of error is this?" decision is shared.
+_ERR_RE = re.compile(
+    r"(401|unauthorized|token"
+    r"|429|quota"
+    r"|503|loading"
+    r"|connection|max retries|dns"
+    r"|timeout|timed out"
+    r"|credit balance|depleted"
+    r"|json|decode)"
+)
+
+_ERR_CLASS = {
+    "401": "auth", "unauthorized": "auth", "token": "auth",
+    "429": "rate_limit", "quota": "rate_limit",
+    "503": "model_loading", "loading": "model_loading",
+    "connection": "network", "max retries": "network", "dns": "network",
+    "timeout": "timeout", "timed out": "timeout",
+    "credit balance": "quota_credit", "depleted": "quota_credit",
+    "json": "bad_response", "decode": "bad_response",
+}
+
+def classify_error(error_str):
+    # Returns a short class name ("auth", "network", ...) for a lowered
+    # error string, or "unknown" if nothing matches.
+    match = _ERR_RE.search(error_str)
+    return _ERR_CLASS[match.group(1)] if match else "unknown"
+
+# Module-level cache for the Sheets connection.
+# Authenticating + opening the spreadsheet costs several HTTPS round-trips,
+# so we do it once per process and reuse the handles on every later call.
+_SHEETS_CACHE = None
+
 def get_google_sheets():
     # 2. GOOGLE SHEETS SETUP
+    # Imported here (not at module top) so startup stays fast on paths
+    # that never touch Sheets.
+    import gspread
+
+    global _SHEETS_CACHE
+
+    # Reuse the cached handles if we already connected in this process.
+    if _SHEETS_CACHE is not None:
+        return _SHEETS_CACHE
+
     # Authenticate using the service account JSON file
     gc = gspread.service_account("chatbot_key.json")
 
@@ -31,32 +99,173 @@ def get_google_sheets():
     ws_process = sh.worksheet("Process")
     ws_done = sh.worksheet("Done")
 
-    return ws_process, ws_done
+    # Store the handles so the next call is a simple tuple lookup (no network).
+    _SHEETS_CACHE = (ws_process, ws_done)
+    return _SHEETS_CACHE
+
+def delete_queue_row():
+    # Removes ROW 2 of the Process tab (the prompt we just used).
+    # Kept separate from append_done_log so the success path can run the
+    # delete while the Telegram upload is in flight, and still write the
+    # Done log only after the upload outcome is known.
+    ws_process, _ = get_google_sheets()
+    ws_process.delete_rows(2)
+
+def append_done_log(log_row):
+    # 2b. DONE-TAB LOGGING
+    # Appends one result row to the "Done" tab. This helper used to
+    # batch the Process-row delete into the same batchUpdate call, but
+    # the upload/log ordering fix superseded that: the delete overlaps
+    # the upload (delete_queue_row) while the log must wait for its
+    # outcome. With a single mutation left, a plain append_row is the
+    # same one RPC without the batch scaffolding.
+    _, ws_done = get_google_sheets()
+    ws_done.append_row(log_row)
+
+# 2c. PROMPT PREFETCH (LOCAL SERVER / .serve() MODE ONLY)
+# In scheduled .serve() mode the process stays alive between runs, so we
+# can fetch the NEXT prompt from Sheets while the current image is still
+# generating (10-30s of GPU time we would otherwise spend idle).
+# Leave this False for GitHub Actions: each run is a fresh process there,
+# so a prefetched prompt would never be consumed.
+PREFETCH_ENABLED = False
+
+# Small in-memory buffer of upcoming prompts, filled by a background thread.
+_PROMPT_BUFFER = queue.Queue(maxsize=2)
+
+def start_prompt_prefetch():
+    # Fetch the next prompt (Row 3 — Row 2 is the one in flight) in the
+    # background. Best-effort: on any error we simply leave the buffer
+    # empty and the next run falls back to the normal fetch path.
+    def _worker():
+        try:
+            ws_process, _ = get_google_sheets()
+            rows = ws_process.get("A3")
+            if rows and rows[0] and rows[0][0].strip():
+                _PROMPT_BUFFER.put_nowait(rows[0][0])
+        except Exception:
+            pass
+
+    thread = threading.Thread(target=_worker, daemon=True)
+    thread.start()
+    return thread
+
+def clear_prompt_buffer():
+    # Drop any prefetched prompt. Must be called whenever a run ends
+    # WITHOUT deleting its queue row: the buffered A3 value is only the
+    # "next" prompt if Row 2 was consumed — otherwise using it would
+    # skip the still-pending Row 2 prompt (and a later cleanup would
+    # delete that row without it ever being processed).
+    while True:
+        try:
+            _PROMPT_BUFFER.get_nowait()
+        except queue.Empty:
+            break
+
+def reset_google_sheets_cache():
+    # Drop the cached connection so the next call re-authenticates.
+    # Used when a Sheets call fails (e.g. expired credentials) so that
+    # Prefect retries start from a fresh client instead of a broken one.
+    global _SHEETS_CACHE
+    _SHEETS_CACHE = None
+
+# The model used for every generation (also part of the cache key below).
+MODEL_ID = "stabilityai/stable-diffusion-xl-base-1.0"
+
+# 3a. LOCAL RESPONSE CACHE (SQLITE)
+# Generated images are stored on disk keyed by sha256(prompt | model).
+# A duplicate prompt — across retries, runs, or even days on a persistent
+# host — comes straight from this file instead of re-running SDXL
+# (seconds to tens of seconds of GPU time). The cache is best-effort:
+# any SQLite error just falls back to a normal generation.
+IMG_CACHE_PATH = "img_cache.sqlite"
+
+def _img_cache_connect():
+    conn = sqlite3.connect(IMG_CACHE_PATH)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS img_cache (hash TEXT PRIMARY KEY, img BLOB, ts INTEGER)"
+    )
+    return conn
 
+def img_cache_lookup(cache_key):
+    # Returns the cached image bytes for this key, or None on a miss.
+    try:
+        conn = _img_cache_connect()
+        try:
+            row = conn.execute(
+                "SELECT img FROM img_cache WHERE hash = ?", (cache_key,)
+            ).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+    except Exception:
+        return None
+
+def img_cache_store(cache_key, img_bytes):
+    # Saves freshly generated image bytes under this key.
+    try:
+        conn = _img_cache_connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO img_cache (hash, img, ts) VALUES (?, ?, ?)",
+                (cache_key, img_bytes, int(datetime.utcnow().timestamp())),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception:
+        pass
+
+@functools.lru_cache(maxsize=1)
 def get_hf_client():
     # 3. HUGGING FACE CLIENT SETUP
-    # Initialize the client for image generation
+    # Lazy import: huggingface_hub is only loaded once a prompt actually
+    # needs generating (the lru_cache keeps this a one-time cost).
+    from huggingface_hub import InferenceClient
+
+    # Initialize the client for image generation.
+    # The lru_cache means we build this ONCE per process: the underlying
+    # HTTP connection pool (DNS + TLS state) is then reused across
+    # Prefect retries instead of being rebuilt on every task run.
+    # "x-use-cache" asks the Inference API to return its cached result
+    # when the exact same prompt was generated before, instead of
+    # re-running the model (~10s of GPU time saved on duplicates/retries).
     return InferenceClient(
-        api_key=HF_TOKEN  # Using the variable defined above
+        api_key=HF_TOKEN,  # Using the variable defined above
+        headers={"x-use-cache": "true"},
     )
 
 @task(name="Fetch Prompt", retries=3, retry_delay_seconds=5)
-def get_prompt():
+async def get_prompt():
     """
     Fetches the first available prompt from the Google Sheet (Row 2).
+
+    The task is async so Prefect can await it on the event loop instead
+    of dispatching to a worker thread; the sync gspread calls run via
+    asyncio.to_thread so they never block the loop.
     """
     print("🔍 Scanning the prompt queue...")
 
+    # Serve-mode fast path: a previous run may have prefetched the next
+    # prompt while its image was generating. Using it skips the RPC.
+    if PREFETCH_ENABLED:
+        try:
+            prompt_text = _PROMPT_BUFFER.get_nowait()
+            print(f"✅ Target Acquired (prefetched): '{prompt_text}'")
+            return prompt_text
+        except queue.Empty:
+            pass
+
     try:
-        ws_process, _ = get_google_sheets()
+        ws_process, _ = await asyncio.to_thread(get_google_sheets)
 
-        # Check if there is data in the first column (Header + at least 1 data row)
-        # We assume Row 1 is Header, Row 2 is Data.
-        if len(ws_process.col_values(1)) > 1:
-            
-            # Fetch the prompt from Row 2, Column 1 (Index 0)
-            prompt_text = ws_process.row_values(2)[0]
+        # Read the prompt cell directly (Row 1 is Header, Row 2 is Data).
+        # One targeted read = ONE API round-trip, and an empty queue
+        # comes back as an empty response instead of a full column fetch.
+        rows = await asyncio.to_thread(ws_process.get, "A2")
+        prompt_text = rows[0][0] if rows and rows[0] else None
 
+        if prompt_text and prompt_text.strip():
             print(f"✅ Target Acquired: '{prompt_text}'")
             return prompt_text
 
@@ -69,11 +278,13 @@ def get_prompt():
         # If a connection error occurs (e.g., Google API down)
         # We re-raise the error so Prefect knows to RETRY this task.
         print(f"❌ Connection Error: {e}")
+        # Drop the cached connection so the retry re-authenticates cleanly.
+        reset_google_sheets_cache()
         # Raise a clean exception so Prefect knows to RETRY this task.
         raise Exception("Google Sheets Connection Failed")
 
 @task(name="Generate Image", retries=3, retry_delay_seconds=5)
-def generate_img(prompt: str):
+async def generate_img(prompt: str):
     """
     Generates an image based on the text prompt using the Fal AI model.
     Returns the image as a Byte Array (in-memory) for Telegram transmission.
@@ -88,14 +299,26 @@ def generate_img(prompt: str):
 
     print(f"🎨 Generating Image for: '{prompt}'")
 
+    # 1b. LOCAL CACHE LOOKUP
+    # If this exact prompt+model was generated before, reuse the stored
+    # bytes and skip the expensive API call entirely.
+    cache_key = hashlib.sha256(f"{prompt}|{MODEL_ID}".encode()).hexdigest()
+    cached_bytes = await asyncio.to_thread(img_cache_lookup, cache_key)
+    if cached_bytes:
+        print("⚡ Cache hit: reusing previously generated image.")
+        return io.BytesIO(cached_bytes)
+
     try:
         client = get_hf_client()
 
         # 2. CALL GENERATION API
-        # Sending request to Black Forest Labs FLUX.1 model
-        image = client.text_to_image(
+        # Sending request to Black Forest Labs FLUX.1 model.
+        # The HTTP call is sync, so we run it in a thread to keep the
+        # event loop free while the GPU works.
+        image = await asyncio.to_thread(
+            client.text_to_image,
             prompt,
-            model="stabilityai/stable-diffusion-xl-base-1.0",
+            model=MODEL_ID,
         )
 
         # 3. OUTPUT VALIDATION
@@ -103,16 +326,34 @@ def generate_img(prompt: str):
         if not image:
             raise ValueError("API returned an empty result (No Image).")
 
+        # 3b. DOWNSCALE FOR TELEGRAM
+        # sendPhoto caps photos at 1280px on the long side server-side,
+        # so larger outputs only waste encode CPU and upload bytes.
+        # SDXL's default 1024x1024 passes through untouched; this guards
+        # against future model/size changes.
+        if max(image.size) > 1280:
+            from PIL import Image  # lazy, like the other heavy imports
+            print(f"📐 Downscaling {image.size[0]}x{image.size[1]} output to fit 1280px...")
+            await asyncio.to_thread(image.thumbnail, (1280, 1280), Image.LANCZOS)
+
         # 4. IMAGE PROCESSING (IN-MEMORY)
         # Create a virtual file in RAM (BytesIO) to avoid saving to hard drive
         img_bytes_arr = io.BytesIO()
-        
-        # Save the PIL image into the buffer as PNG format
-        image.save(img_bytes_arr, format="PNG")
-        
+
+        # Save the PIL image into the buffer as JPEG.
+        # JPEG at quality 90 is ~3-5x smaller and much faster to encode
+        # than PNG's deflate, and Telegram recompresses photos anyway.
+        # (SDXL output is RGB, so we lose nothing by skipping PNG alpha.)
+        await asyncio.to_thread(image.save, img_bytes_arr, format="JPEG", quality=90)
+
         # Reset the cursor to the beginning of the file so it can be read later
         img_bytes_arr.seek(0)
-        
+
+        # 4b. LOCAL CACHE STORE
+        # Remember the encoded bytes so a repeat of this prompt skips
+        # the generation step next time.
+        await asyncio.to_thread(img_cache_store, cache_key, img_bytes_arr.getvalue())
+
         print("✅ Image generated and converted to bytes successfully.")
         return img_bytes_arr
 
@@ -123,57 +364,50 @@ def generate_img(prompt: str):
         error_str = str(e).lower()
 
         # --- DETECT ERROR TYPE SAFELY ---
+        # One shared classification (see classify_error), then dispatch
+        # on the class. Messages stay local to this task.
+        error_class = classify_error(error_str)
 
         # CASE 1: Authentication Error (Wrong Token)
-        if "401" in error_str or "unauthorized" in error_str or "token" in error_str:
+        if error_class == "auth":
             clean_msg = "🔒 AUTH ERROR: Hugging Face Token is invalid or missing."
             print(clean_msg)
             # Critical error: Stop execution immediately.
             raise ValueError(clean_msg)
 
-        # CASE 2: Rate Limit (Free tier limits)
-        elif "429" in error_str:
-            clean_msg = "⏳ RATE LIMIT: Hugging Face API limit reached. Please wait."
-            print(clean_msg)
-            # Raise exception to trigger Prefect retries.
-            raise Exception(clean_msg)
-
-        # CASE 3: Model Loading (Common in HF Inference API)
-        # This usually resolves itself after a few seconds.
-        elif "503" in error_str or "loading" in error_str:
-            clean_msg = "🏗️ MODEL BUSY: The model is currently loading on Hugging Face servers."
-            print(clean_msg)
-            # Raise exception to trigger Prefect retries.
-            raise Exception(clean_msg)
-
-        # CASE 4: Network/Connection Errors
-        elif "connection" in error_str or "max retries" in error_str:
-            clean_msg = "❌ NETWORK ERROR: Failed to connect to Hugging Face API."
-            print(clean_msg)
-            # Raise exception to trigger Prefect retries.
-            raise Exception(clean_msg)
-
-        # CASE 5: API Key Quota / Credit Depleted (Business Logic)
-        # This checks for specific billing error messages.
-        elif "credit balance" in error_str or "depleted" in error_str:
+        # CASE 2: API Key Quota / Credit Depleted (Business Logic)
+        elif error_class == "quota_credit":
             warning_msg = "💳 QUOTA EXCEEDED: Your Hugging Face credit balance is depleted. Purchase credits or upgrade to Pro."
             print(f"Status: {warning_msg}")
-            
+
             # NOTE: We RETURN the warning string here instead of raising an exception.
-            # This allows the Main Flow to catch this specific string and send it 
+            # This allows the Main Flow to catch this specific string and send it
             # as a notification message to the Telegram user.
             return warning_msg
 
-        # CASE 6: Unknown Error
+        # CASE 3: Transient Errors (Rate Limit / Model Loading / Network)
+        # All of these resolve themselves, so we raise to trigger
+        # Prefect retries with the matching message.
+        elif error_class in ("rate_limit", "model_loading", "network"):
+            clean_msg = {
+                "rate_limit": "⏳ RATE LIMIT: Hugging Face API limit reached. Please wait.",
+                "model_loading": "🏗️ MODEL BUSY: The model is currently loading on Hugging Face servers.",
+                "network": "❌ NETWORK ERROR: Failed to connect to Hugging Face API.",
+            }[error_class]
+            print(clean_msg)
+            # Raise exception to trigger Prefect retries.
+            raise Exception(clean_msg)
+
+        # CASE 4: Unknown Error
         else:
             print("🔥 GENERATION FAILED: An unknown error occurred during image generation.")
             print("   (Raw error details hidden for security)")
-            
+
             # Raise a generic exception to mark the task as Failed.
             raise Exception("Unknown Image Generation Error")
 
 @task(name="Send to Telegram", retries=3, retry_delay_seconds=5)
-def to_telegram(caption, img):
+async def to_telegram(caption, img):
     """
     Sends the generated image and caption to the specified Telegram Chat.
     """
@@ -185,7 +419,7 @@ def to_telegram(caption, img):
     # We must send the file as a tuple: (filename, file_data, mime_type)
     # This tells requests how to format the binary data properly.
     files = {
-        "photo": ("generated_image.png", img, "image/png")
+        "photo": ("generated_image.jpg", img, "image/jpeg")
     }
 
     # 3. PREPARE DATA PAYLOAD
@@ -198,25 +432,33 @@ def to_telegram(caption, img):
     print(f"🚀 Sending image to Telegram Chat ID: {TELEGRAM_CHAT_ID}...")
 
     # 4. SEND REQUEST
+    # timeout=(connect, read): a hung socket must not wedge the Prefect
+    # worker — bounding it lets the retry budget actually cycle.
     try:
-        response = requests.post(url, files=files, data=data)
-        
+        response = await asyncio.to_thread(
+            session.post, url, files=files, data=data, timeout=(5, 30)
+        )
+
         # 5. VALIDATE RESPONSE
         if response.status_code == 200:
             print("✅ Success: Message delivered to Telegram!")
         else:
             # If the API returns an error (e.g., 400 Bad Request, 401 Unauthorized)
             print(f"❌ Telegram Refused: Status Code {response.status_code}")
-            
+
             # CRITICAL: Raise an exception so Prefect knows this task FAILED.
             raise Exception(f"Telegram API Error: {response.status_code}")
-            
+
+    except requests.exceptions.Timeout:
+        print("❌ Timeout: Telegram API did not respond in time.")
+        raise Exception("Operation Timed Out")
+
     except Exception as e:
         print(f"❌ Network Error sending to Telegram.")
         raise Exception("Telegram Connection Failed")
 
 @task(name="Send Information to Telegram", retries=3, retry_delay_seconds=5)
-def send_information(information):
+async def send_information(information):
     # 1. Validate Credentials
     if not TELEGRAM_TOKEN and not TELEGRAM_CHAT_ID:
         error_msg = "Error: Telegram credentials are missing."
@@ -238,7 +480,8 @@ def send_information(information):
 
     try:
         # 4. Send POST request
-        response = requests.post(url, json=data)
+        # Bounded timeout so a hung socket cannot stall the retry cycle.
+        response = await asyncio.to_thread(session.post, url, json=data, timeout=(5, 15))
         
         # 5. Check HTTP Status
         if response.status_code == 200:
@@ -248,7 +491,14 @@ def send_information(information):
             error_details = f"Telegram API Refused: {response.status_code} - {response.text}"
             print(error_details)
             raise Exception(error_details)
-            
+
+    except requests.exceptions.Timeout:
+        # Explicit timeout mapping (a requests Timeout message does not
+        # always contain the word "timeout").
+        clean_error_msg = "Timeout Error: Telegram API did not respond."
+        print(clean_error_msg)
+        raise Exception(clean_error_msg)
+
     except Exception as e:
         # 6. Handle Network/Connection Errors
         error_str = str(e).lower()
@@ -269,10 +519,14 @@ def send_information(information):
         raise Exception(clean_error_msg)
 
 @flow(name="Daily Image Generator Flow", log_prints=True)
-def main_flow():
+async def main_flow():
     """
-    The main orchestrator. It fetches a prompt, generates an image, 
+    The main orchestrator. It fetches a prompt, generates an image,
     sends it to Telegram, and logs the result to Google Sheets.
+
+    Async flow + async tasks: every task is pure I/O (HTTP to Hugging
+    Face, Telegram, Sheets), so they all share one event loop instead of
+    paying a thread-pool handoff per task.
     """
     
     # 1. INITIALIZE VARIABLES
@@ -280,39 +534,47 @@ def main_flow():
     prompt_text = "No Prompt"
     last_status = "UNKNOWN"
     status_information = "Process Started"
+    row_deleted = False
     
     # Get current server time (UTC) and convert to WIB (UTC+7)
     current_time = (datetime.utcnow() + timedelta(hours=7)).strftime("%Y-%m-%d %H:%M:%S")
 
+    # 2. FETCH PROMPT (BEFORE BUILDING ANYTHING ELSE)
+    # get_prompt opens the (cached) Sheets connection itself, so this is
+    # the flow's only setup cost. On an empty queue we return right
+    # here: no Hugging Face client, no Telegram traffic, and no log row
+    # for a run that did nothing.
     try:
-        ws_process, ws_done = get_google_sheets()
-    except Exception as e:
-        # SAFE LOGGING: Connection errors usually don't leak secrets, 
-        # but it's better to be generic just in case.
+        prompt_text = await get_prompt()
+    except Exception:
+        # SAFE LOGGING: Connection errors usually don't leak secrets,
+        # but it's better to be generic just in case. (get_prompt has
+        # already retried with a fresh connection at this point.)
         print("❌ CRITICAL ERROR: Failed to connect to Google Sheets.")
         print("   (Check credentials.json or API limits)")
         # STOP execution by raising the error
         raise Exception("Google Sheets Connection Failed")
 
-    try:
-        # 2. FETCH PROMPT
-        # Calls the task to get text from the 'Process' sheet
-        prompt_text = get_prompt()
-
-        # If the sheet is empty (returns None), we stop the flow immediately.
-        if prompt_text is None or prompt_text.strip() == "":
-            print("🛑 No prompt found. Stopping flow.")
-            return
+    # If the sheet is empty (returns None), we stop the flow immediately.
+    if prompt_text is None or prompt_text.strip() == "":
+        print("🛑 No prompt found. Stopping flow.")
+        return
 
+    try:
         # 3. GENERATE IMAGE
+        # In serve mode, fetch the NEXT prompt in the background while
+        # the GPU works on the current one (see start_prompt_prefetch).
+        if PREFETCH_ENABLED and _PROMPT_BUFFER.empty():
+            start_prompt_prefetch()
+
         # Calls the task. Can return: Bytes (Success), String (Warning), or None (Critical Error).
-        result = generate_img(prompt_text)
+        result = await generate_img(prompt_text)
 
         # --- CHECK RESULT TYPE ---
         if result is None:
             # CASE A: CRITICAL SERVER ERROR (Result is None)
             print("❌ Failed to generate image. Stopping flow.")
-            send_information("❌ Sorry, failed to generate image due to server error.")
+            await send_information("❌ Sorry, failed to generate image due to server error.")
 
             last_status = "FAILED"
             status_information = "❌ Sorry, failed to generate image due to server error."   
@@ -320,30 +582,43 @@ def main_flow():
         elif isinstance(result, str):
             # CASE B: SPECIFIC WARNING / QUOTA LIMIT (Result is Text)
             # We send the warning text directly to the user.
-            send_information(result)
+            await send_information(result)
 
             last_status = "FAILED"
             status_information = result
             
         else:
             # CASE C: SUCCESS (Result is Image Bytes)
-            
-            # 4. SEND TO TELEGRAM
-            # We use the prompt text as the caption so we know what generated the image.
-            to_telegram(caption=prompt_text, img=result)
 
-            # 5. UPDATE STATUS (Success)
+            # 4+5. SEND TO TELEGRAM + CLEAN UP QUEUE (SIDE BY SIDE)
+            # The upload and the row-delete hit unrelated services, so
+            # they run together. The Done log is deliberately NOT part
+            # of this pair: it must record the real outcome of the send,
+            # so it waits for the finally block below. We use the prompt
+            # text as the caption so we know what generated the image.
+            print("🧹 Cleaning up processed row while the upload runs...")
+            telegram_result, delete_result = await asyncio.gather(
+                to_telegram(caption=prompt_text, img=result),
+                asyncio.to_thread(delete_queue_row),
+                return_exceptions=True,
+            )
+
+            # 6. PROPAGATE ERRORS
+            # A failed upload (or failed cleanup) must still fail the
+            # flow — and must reach the except-block BEFORE the status
+            # is marked SUCCESS, so the Done sheet records the truth.
+            row_deleted = not isinstance(delete_result, BaseException)
+            if isinstance(telegram_result, BaseException):
+                raise telegram_result
+            if isinstance(delete_result, BaseException):
+                raise delete_result
+
+            # 7. UPDATE STATUS (Success) — only now that the send is confirmed.
             last_status = "SUCCESS"
             status_information = "Image sent to Telegram successfully."
 
-            # 6. CLEAN UP QUEUE (CRITICAL FIX)
-            # We delete ROW 2 (the data we just used), not the column.
-            # This ensures the next run picks up the next prompt.
-            print("🧹 Cleaning up processed row...")
-            ws_process.delete_rows(2)
-
     except Exception as e:
-        # 7. ERROR HANDLING (Safe & Graceful Failure)
+        # 8. ERROR HANDLING (Safe & Graceful Failure)
         last_status = "FAILED"
         
         # Convert error to string for analysis (internal only)
@@ -352,19 +627,15 @@ def main_flow():
         # --- SAFE ERROR CATEGORIZATION ---
         # We define a "Clean Message" to print and save to Sheets.
         # This prevents the raw URL (with Token) from being saved.
-
-        if "connection" in error_str or "max retries" in error_str:
-            clean_msg = "Network/Connection Error (Internet or DNS)"
-        elif "401" in error_str or "unauthorized" in error_str:
-            clean_msg = "Authentication Error (Check API Keys)"
-        elif "429" in error_str or "quota" in error_str:
-            clean_msg = "Rate Limit / Quota Exceeded"
-        elif "timeout" in error_str:
-            clean_msg = "Operation Timed Out"
-        elif "json" in error_str or "decode" in error_str:
-            clean_msg = "API Response Error (Invalid JSON)"
-        else:
-            clean_msg = "Internal Error (Details hidden for security)"
+        # Uses the shared classifier (see classify_error) instead of
+        # repeating the substring checks from generate_img.
+        clean_msg = {
+            "network": "Network/Connection Error (Internet or DNS)",
+            "auth": "Authentication Error (Check API Keys)",
+            "rate_limit": "Rate Limit / Quota Exceeded",
+            "timeout": "Operation Timed Out",
+            "bad_response": "API Response Error (Invalid JSON)",
+        }.get(classify_error(error_str), "Internal Error (Details hidden for security)")
 
         # Print the CLEAN message to console
         print(f"🔥 Flow Failed: {clean_msg}")
@@ -377,11 +648,26 @@ def main_flow():
         raise Exception(clean_msg)
 
     finally:
-        # 8. LOGGING (Always Runs)
+        # 8b. PREFETCH INVALIDATION
+        # A prefetched prompt is only the "next" one if this run
+        # consumed its row. If the row survived (any failure path),
+        # drop the buffer so the next run re-reads A2 instead of
+        # skipping the prompt that is still pending.
+        if PREFETCH_ENABLED and not row_deleted:
+            clear_prompt_buffer()
+
+        # 9. LOGGING (Always Runs)
         # --- SAFE NESTED TRY-EXCEPT (NO RAW ERROR PRINTING) ---
         try:
             print("📝 Logging result to spreadsheet...")
-            ws_done.append_row([prompt_text, last_status, status_information, current_time])
+            # Written here — after the try/except has settled — so the
+            # row always reflects the run's real outcome. The queue row
+            # itself was already handled in the success branch. Like
+            # every other gspread call, this runs off the event loop.
+            await asyncio.to_thread(
+                append_done_log,
+                [prompt_text, last_status, status_information, current_time],
+            )
         except Exception:
             # We DO NOT print 'final_e' here to avoid any potential leaks.
             # We just print a generic static message.
@@ -396,7 +682,8 @@ if __name__ == "__main__":
     # This calls the function immediately (Run Once).
     # GitHub's YAML scheduler handles the timing (CRON).
     # When finished, the script exits to save server resources.
-    main_flow()
+    # (The flow is async, so we drive it with asyncio.run.)
+    asyncio.run(main_flow())
 
     # --- OPTION 2: FOR LOCAL SERVER / VPS (COMMENTED OUT) ---
     # Use this if you run the script on your own laptop or a 24/7 server.